@@ -1,7 +1,6 @@
 """ A parser for the query mini-language
-The parser takes advantage of the fact that the query language is syntactically equivalent to a subset of Python's expression syntax, so
-we convert qwuery strings to syntactically equivalent Python expressions, and use Python's parser to create their
-abstract syntax trees
+The query language is syntactically a small subset of Python's expression syntax. Rather than piggybacking on
+Python's own parser, we use a small recursive-descent parser which produces our AST nodes directly from the query.
 
 Specifically the query language has the following properties:
 * Supported operators
@@ -14,141 +13,379 @@ left-hand side of a relational operator determines the expected format of the li
 * As in SQL, C, Python etc., AND has higher precedences than OR. Parenthesis may be used to set any precedence.
 """
 
+from __future__ import annotations
+
 import re
-import ast
 import typing
+import weakref
+import functools
+import contextlib
 import dataclasses
 import operator
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True)
 class Comparison:
+    __slots__ = ("op", "name", "value", "__weakref__")
+
     op: typing.Callable
     name: str
     value: typing.Any
 
-@dataclasses.dataclass
+    def __reduce__(self) -> typing.Tuple[type, typing.Tuple]:
+        # The default state restoring for slots uses setattr, which frozen dataclasses forbid
+        return (type(self), (self.op, self.name, self.value))
+
+@dataclasses.dataclass(frozen=True)
 class LogicalOperator:
+    __slots__ = ("op", "operands", "__weakref__")
+
     op: typing.Callable
-    operands: typing.Sequence
+    operands: typing.Tuple
+
+    def __reduce__(self) -> typing.Tuple[type, typing.Tuple]:
+        # See Comparison.__reduce__
+        return (type(self), (self.op, self.operands))
+
+_Node = typing.Union[Comparison, LogicalOperator]
+_Row = typing.Mapping[str, typing.Any]
+_Predicate = typing.Callable[[_Row], bool]
+_Token = typing.Tuple[str, str, int]
+_NodeT = typing.TypeVar("_NodeT", Comparison, LogicalOperator)
+
+_NODE_INTERN: weakref.WeakValueDictionary[tuple, _Node] = weakref.WeakValueDictionary()
+"Canonical instances of the AST nodes currently in use, so that equal sub-trees of different queries are shared"
+
+def _intern(node: _NodeT) -> _NodeT:
+    if isinstance(node, Comparison):
+        # Equal values may still differ, e.g. 1 and Decimal(1), Decimal('1.0') and Decimal('1.00'), 0.0 and -0.0 or
+        # aware datetimes in different time zones. Only merge values with the same type and representation
+        key: tuple = (Comparison, node.op, node.name, type(node.value), node.value, repr(node.value))
+    else:
+        # The operands have been interned already, so their identities determine the sub-tree
+        key = (LogicalOperator, node.op, tuple(map(id, node.operands)))
+
+    try:
+        return _NODE_INTERN.setdefault(key, node)     # type: ignore[return-value]
+    except TypeError:   # Converters may produce unhashable values
+        return node
+
+def _identity(node: _NodeT) -> _NodeT:
+    return node
+
+def _compile_node(node: _Node) -> _Predicate:
+    if isinstance(node, Comparison):
+        op, name, value = node.op, node.name, node.value
+        return lambda row: op(row[name], value)
+
+    predicates = tuple([_compile_node(operand) for operand in node.operands])
+    if node.op is operator.not_:
+        predicate, = predicates
+        return lambda row: not predicate(row)
+    elif node.op is operator.and_:
+        return lambda row: all(p(row) for p in predicates)
+    else:
+        return lambda row: any(p(row) for p in predicates)
+
+def _numpy_mask(node: _Node, columns: typing.Mapping[str, typing.Any]) -> typing.Any:
+    if isinstance(node, Comparison):
+        return node.op(columns[node.name], node.value)
+
+    import numpy
+
+    masks = [_numpy_mask(operand, columns) for operand in node.operands]
+    if node.op is operator.not_:
+        mask, = masks
+        return numpy.logical_not(mask)
+    elif node.op is operator.and_:
+        return numpy.logical_and.reduce(masks)
+    else:
+        return numpy.logical_or.reduce(masks)
+
+_TOKEN_RE = re.compile(r"""
+      (?P<WS>\s+)
+    # There is no binary minus, so a minus sign directly followed by digits is folded into the literal
+    | (?P<NUMBER>-?(?:\d+(?:\.\d*)?|\.\d+))
+    | (?P<STRING>'[^'\n]*'|"[^"\n]*")
+    | (?P<UNTERMINATED>['"])
+    | (?P<RELOP>(?:==|!=|>=|<=|>|<)(?![<>=]))
+    | (?P<NAME>[A-Za-z_]\w*)
+    | (?P<LPAREN>\()
+    | (?P<RPAREN>\))
+    | (?P<MINUS>-)
+    | (?P<OTHER>.)
+""", re.VERBOSE | re.ASCII)     # Only ASCII digits and whitespace, as in the query language's grammar
+
+# Words that are tokenized as operators rather than as field names. Keywords are told apart from names by a single
+# dict lookup on each word, rather than by trying each of them as an alternative in _TOKEN_RE
+_KEYWORDS = {
+    "eq": "RELOP", "ne": "RELOP", "gt": "RELOP", "lt": "RELOP", "ge": "RELOP", "le": "RELOP",
+    "and": "LOGOP", "or": "LOGOP",
+    "not": "NOT",
+}
+
+# Matches queries made of a single comparison, which can be parsed without going through the tokenizer.
+# Must accept exactly what the tokenizer and parser would accept as a single comparison; anything else takes the slow path.
+# Only the keywords are matched case-insensitively: under Unicode case folding [A-Za-z_] would also match e.g. the
+# Kelvin sign, which the tokenizer rejects. Like the tokenizer, only ASCII digits and whitespace are matched
+_FAST_SINGLE_RE = re.compile(r"""
+    \s*
+    (?!(?i:and|or|not|eq|ne|gt|lt|ge|le)\b)([A-Za-z_]\w*)\b
+    \s*
+    ((?:==|!=|>=|<=|>|<)(?![<>=])|\b(?i:eq|ne|gt|lt|ge|le)\b)
+    \s*
+    (?:'([^'\n]*)'|"([^"\n]*)"|(-?(?:\d+(?:\.\d*)?|\.\d+)))
+    \s*\Z
+""", re.VERBOSE | re.ASCII)
 
 class QueryAst:
-    def __init__(self, query: str, field_value_converters: typing.Mapping[str, typing.Callable] = {}):
+    def __init__(self, query: str, field_value_converters: typing.Mapping[str, typing.Callable] = {},
+                 intern_nodes: bool = False) -> None:
+        """ Parse the query, converting literal values using the converter given for the field they are compared with.
+        With intern_nodes, equal sub-trees are shared with those of other queries parsed the same way. This saves memory
+        when many cached queries share fragments, but makes uncached parsing of compound queries about 50% slower.
+        """
         self.query_text = query.strip()
-        self.field_value_converters = field_value_converters      # TODO: Require this to be non-empty!
-        self.ast = self._make_ast(self.query_text)
+        # TODO: Require this to be non-empty!
+        self.field_value_converters = { name.lower(): converter for name, converter in field_value_converters.items() }
+        converters_items = tuple(sorted(self.field_value_converters.items()))
+        # The tree is shared by all instances created with the same query and converters
+        if self._cache_enabled and self._is_hashable(converters_items):
+            self.ast = self._compile_cached(self.query_text, converters_items, intern_nodes)
+        else:
+            self.ast = self._compile_cached.__wrapped__(type(self), self.query_text, converters_items, intern_nodes)
+
+    @staticmethod
+    def _is_hashable(value: typing.Any) -> bool:
+        try:
+            hash(value)
+        except TypeError:   # E.g. converters which are instances of non-frozen dataclasses
+            return False
+        return True
+
+    _cache_enabled: typing.ClassVar[bool] = True
+
+    @classmethod
+    @functools.lru_cache(maxsize=1024)
+    def _compile_cached(cls, query_text: str, converters_items: typing.Tuple[typing.Tuple[str, typing.Callable], ...],
+                        intern_nodes: bool) -> _Node:
+        # The resulting trees are frozen, so they may be safely shared between all QueryAst instances with the same
+        # query text and converters. Since the converted values are shared as well, converters must be pure functions
+        # of the literal value: e.g. a converter whose result depends on the current date would keep returning the
+        # value computed when the query was first parsed
+        field_value_converters = dict(converters_items)
+        return _Parser(query_text, field_value_converters.__getitem__, intern_nodes).parse()
+
+    def compile(self) -> _Predicate:
+        "Return a predicate which evaluates the query on a row, given as a mapping of lower-case field names to values"
+        return _compile_node(self.ast)
+
+    def to_numpy_mask(self, columns: typing.Mapping[str, typing.Any]) -> typing.Any:
+        """ Evaluate the query over a batch of rows given as NumPy arrays, keyed by lower-case field names
+        Returns a boolean array, which is True for the rows matching the query. Requires NumPy.
+        """
+        return _numpy_mask(self.ast, columns)
+
+    @classmethod
+    def cache_clear(cls) -> None:
+        "Discard all cached query ASTs"
+        cls._compile_cached.cache_clear()
+
+    @classmethod
+    def warm(cls, queries: typing.Iterable[str], field_value_converters: typing.Mapping[str, typing.Callable] = {},
+             intern_nodes: bool = False) -> None:
+        "Parse the given queries into the cache ahead of time, e.g. at startup"
+        for query in queries:
+            cls(query, field_value_converters, intern_nodes)
 
-    PSEUDO_FILENAME = "<web request>"
+    @staticmethod
+    @contextlib.contextmanager
+    def parse_cache_disabled() -> typing.Iterator[None]:
+        """ Within this context, queries are parsed without using or updating the cache. Meant for benchmarking.
+        This is process-wide: it also affects queries parsed concurrently in other threads, e.g. by other requests.
+        """
+        was_enabled = QueryAst._cache_enabled
+        QueryAst._cache_enabled = False
+        try:
+            yield
+        finally:
+            QueryAst._cache_enabled = was_enabled
+
+    PSEUDO_FILENAME: typing.ClassVar[str] = "<web request>"
     "Value that will be given as 'filename' when reporting syntax errors"
 
-    _rel_ops_mapping = {
-        "eq": "==",
-        "ne": "!=",
-        "gt": " >",
-        "lt": " <",
-        "ge": ">=",
-        "le": "<=",
+class _Parser:
+    "A recursive-descent parser for a single query"
+
+    def __init__(self, query: str, get_converter: typing.Callable[[str], typing.Callable], intern_nodes: bool) -> None:
+        self.query = query
+        self._get_converter = get_converter
+        self._intern: typing.Callable[[typing.Any], typing.Any] = _intern if intern_nodes else _identity
+
+    _rel_ops: typing.ClassVar[typing.Dict[str, typing.Callable]] = {
+        "eq": operator.eq, "==": operator.eq,
+        "ne": operator.ne, "!=": operator.ne,
+        "gt": operator.gt, ">":  operator.gt,
+        "lt": operator.lt, "<":  operator.lt,
+        "ge": operator.ge, ">=": operator.ge,
+        "le": operator.le, "<=": operator.le,
     }
 
-    # Make sure we always substitute strings with strings of the same length, to get accurate error reporting
-    assert(len(k) == len(v) for k, v in _rel_ops_mapping.items())
+    def _tokenize(self, query: str) -> typing.List[_Token]:
+        tokens = []
+        # The last alternative of _TOKEN_RE matches any character, so the matches cover the entire query
+        for m in _TOKEN_RE.finditer(query):
+            kind: str = m.lastgroup     # type: ignore[assignment]
+            if kind == "WS":
+                continue
+            elif kind == "UNTERMINATED":
+                self._raise_syntax_error("EOL while scanning string literal", m.start())
 
-    _rel_op_re = re.compile("\\b({})\\b".format("|".join(_rel_ops_mapping)))
+            # Operators, field-names and values are all case-insensitive
+            text = m.group().lower()
+            if kind == "NAME":
+                kind = _KEYWORDS.get(text, kind)
+            tokens.append((kind, text, m.start()))
 
-    def _make_ast(self, query: str) -> None:
-        try:
-            self.py_ast = ast.parse(self._query_to_python_expression(query), self.PSEUDO_FILENAME, mode="eval")
-            try:
-                root_node, = ast.iter_child_nodes(self.py_ast)
-            except ValueError:
-                self._raise_syntax_error("Multiple expressions or none. Exactly 1 expression is required", root_node)
-            our_ast = self._parse_node(root_node)
-        except SyntaxError as se:
-            lines = query.splitlines()
-            details = tuple(se.args[1])[:-1] + (lines[se.lineno - 1],)
-            raise SyntaxError(se.args[0], details)
+        # Like Python's parser, report an unexpected end of the query at its last character
+        tokens.append(("EOF", "", max(len(query) - 1, 0)))
+        return tokens
 
-        return our_ast
+    def _next(self) -> _Token:
+        token = self._tokens[self._index]
+        self._index += 1
+        return token
 
-    @classmethod
-    def _query_to_python_expression(cls, query: str) -> str:
-        parts = cls._rel_op_re.split(query.lower())
-        parts_converted = ( cls._rel_ops_mapping.get(p, p) for p in parts )
-        return "".join(parts_converted)
-
-    def _parse_node(self, node):
-        if isinstance(node, ast.Compare):
-            return self._parse_comparison(node)
-        elif isinstance(node, ast.BoolOp) or isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
-            return self._parse_boolean_expression(node)
-        else:
-            self._raise_syntax_error("Unsupported expression", node)
-
-    def _parse_boolean_expression(self, node):
-        child_nodes = ast.iter_child_nodes(node)
-        ast_op = next(child_nodes)
-        if isinstance(ast_op, ast.And):
-            op = operator.and_
-        elif isinstance(ast_op, ast.Or):
-            op = operator.or_
-        elif isinstance(ast_op, ast.Not):
-            op = operator.not_
+    def parse(self) -> _Node:
+        m = _FAST_SINGLE_RE.match(self.query)
+        if m is not None:
+            return self._parse_single_comparison(m)
+
+        self._tokens = self._tokenize(self.query)
+        self._index = 0
+        node = self.parse_or()
+        kind, _, pos = self._tokens[self._index]
+        if kind == "RPAREN":
+            self._raise_syntax_error("unmatched ')'", pos)
+        elif kind != "EOF":
+            self._raise_syntax_error("Unsupported expression", pos)
+        return node
+
+    _logical_ops: typing.ClassVar[typing.Dict[str, typing.Callable]] = {
+        "or": operator.or_,
+        "and": operator.and_,
+    }
+
+    def parse_or(self) -> _Node:
+        return self._parse_logical("or", self.parse_and)
+
+    def parse_and(self) -> _Node:
+        return self._parse_logical("and", self.parse_not)
+
+    def _parse_logical(self, op_name: str, parse_operand: typing.Callable[[], _Node]) -> _Node:
+        operands = [parse_operand()]
+        while self._tokens[self._index][:2] == ("LOGOP", op_name):
+            self._index += 1
+            operands.append(parse_operand())
+        return operands[0] if len(operands) == 1 else self._intern(LogicalOperator(self._logical_ops[op_name], tuple(operands)))
+
+    def parse_not(self) -> _Node:
+        if self._tokens[self._index][0] == "NOT":
+            self._index += 1
+            return self._intern(LogicalOperator(operator.not_, (self.parse_not(),)))
+        return self.parse_atom()
+
+    def parse_atom(self) -> _Node:
+        token = self._tokens[self._index]
+        kind = token[0]
+        if kind == "LPAREN":
+            self._index += 1
+            node = self.parse_or()
+            token = self._next()
+            if token[0] != "RPAREN":
+                self._raise_unexpected(token, "invalid syntax")
+            return node
+        elif kind == "NAME":
+            return self.parse_comparison()
         else:
-            assert not f"Unrecognized logical operator: {ast_op}"
+            self._raise_unexpected(token, "Unsupported expression")
 
-        operands = tuple(map(self._parse_node, child_nodes))
-        return LogicalOperator(op, operands)
+    def parse_comparison(self) -> Comparison:
+        _, name, _ = self._next()
+        token = self._next()
+        kind, op_text, op_pos = token
+        if kind == "NAME":
+            self._raise_syntax_error(f"Unknown comparison operator '{op_text}'", op_pos)
+        elif kind != "RELOP":
+            self._raise_unexpected(token, "Unsupported expression")
 
-    def _parse_comparison(self, node) -> Comparison:
-        assert isinstance(node, ast.Compare)
-        name_node, ast_op, value_node = ast.iter_child_nodes(node)
-        assert isinstance(name_node, ast.Name)
+        return self._make_comparison(name, op_text, self._parse_value())
 
-        value = self._parse_value_node(value_node)
-        value_converter = self.field_value_converters.get(name_node.id)
-        if value_converter is None:
-            raise NameError(f"No such field '{name_node.id}'")
-        converted_value = value_converter(value)
+    def _parse_single_comparison(self, m: re.Match) -> Comparison:
+        name, op_text, single_quoted, double_quoted, number = m.groups()
+        if number is None:
+            value = (double_quoted if single_quoted is None else single_quoted).lower()
+        else:
+            value = self._number_value(number)
+        return self._make_comparison(name.lower(), op_text.lower(), value)
 
+    def _make_comparison(self, name: str, op_text: str, value: typing.Union[str, int, float]) -> Comparison:
         try:
-            op = self._convert_rel_op(ast_op, node)
-        except (ValueError, TypeError) as e:
-            raise e.__class__(f"Failed to apply converter to field '{name_node.id}'" )from e
-        return Comparison(op, name_node.id, converted_value)
+            value_converter = self._get_converter(name)
+        except KeyError:
+            raise NameError(f"No such field '{name}'") from None
 
-    @classmethod
-    def _parse_value_node(cls, value_node):
-        if isinstance(value_node, ast.Str):
-            return value_node.s
-        elif isinstance(value_node, ast.Num):
-            return value_node.n
-        elif isinstance(value_node, ast.UnaryOp) and isinstance(value_node.op, ast.USub):
-            try:
-                return - cls._parse_value_node(value_node.operand)
-            except TypeError:
-                cls._raise_syntax_error("Attempt to negate non-number", value_node)
+        if type(value) is value_converter:
+            # The converter is a type such as int or float, and the literal is already of that type
+            converted_value = value
         else:
-            cls._raise_syntax_error("Value is not a number or a string", value_node)
+            try:
+                converted_value = value_converter(value)
+            except (ValueError, TypeError) as e:
+                raise e.__class__(f"Failed to apply converter to field '{name}'") from e
+        return self._intern(Comparison(self._rel_ops[op_text], name, converted_value))
 
-    @classmethod
-    def _convert_rel_op(cls, ast_op, node) -> typing.Callable:
-        if isinstance(ast_op, ast.Eq):
-            return operator.eq
-        elif isinstance(ast_op, ast.NotEq):
-            return operator.ne
-        elif isinstance(ast_op, ast.Gt):
-            return operator.gt
-        elif isinstance(ast_op, ast.Lt):
-            return operator.lt
-        elif isinstance(ast_op, ast.GtE):
-            return operator.ge
-        elif isinstance(ast_op, ast.LtE):
-            return operator.le
-
-        op_name = ast_op.__class__.__name__.lower()
-        cls._raise_syntax_error(f"Unknown comparison operator '{op_name}'", node)
+    def _parse_value(self) -> typing.Union[str, int, float]:
+        token = self._next()
+        value_parser = self._value_parsers.get(token[0])
+        if value_parser is None:
+            self._raise_unexpected(token, "Value is not a number or a string")
+        return value_parser(self, token)
 
-    @classmethod
-    def _raise_syntax_error(cls, message: str, node):
-        raise SyntaxError(message,
-            (cls.PSEUDO_FILENAME, getattr(node, "lineno", 1), getattr(node, "col_offset", 0), ""))
+    @staticmethod
+    def _number_value(text: str) -> typing.Union[int, float]:
+        return float(text) if "." in text else int(text)
+
+    def _parse_number(self, token: _Token) -> typing.Union[int, float]:
+        return self._number_value(token[1])
+
+    def _parse_string(self, token: _Token) -> str:
+        return token[1][1:-1]
+
+    def _parse_negation(self, token: _Token) -> typing.Union[int, float]:
+        value = self._parse_value()
+        if isinstance(value, str):
+            self._raise_syntax_error("Attempt to negate non-number", token[2])
+        return - value
+
+    _value_parsers: typing.ClassVar[typing.Dict[str, typing.Callable[[_Parser, _Token], typing.Union[str, int, float]]]] = {
+        "NUMBER": _parse_number,
+        "STRING": _parse_string,
+        "MINUS": _parse_negation,
+    }
+
+    def _raise_unexpected(self, token: _Token, message: str) -> typing.NoReturn:
+        kind, _, pos = token
+        if kind == "EOF":
+            message = "unexpected EOF while parsing"
+        self._raise_syntax_error(message, pos)
+
+    def _raise_syntax_error(self, message: str, pos: int) -> typing.NoReturn:
+        lineno = self.query.count("\n", 0, pos) + 1
+        line_start = self.query.rfind("\n", 0, pos) + 1
+        line_end = self.query.find("\n", pos)
+        line = self.query[line_start:] if line_end < 0 else self.query[line_start:line_end]
+        raise SyntaxError(message, (QueryAst.PSEUDO_FILENAME, lineno, pos - line_start + 1, line))
+
+# Every relational operator must be tokenized as such
+assert all(_KEYWORDS.get(op, getattr(_TOKEN_RE.fullmatch(op), "lastgroup", None)) == "RELOP" for op in _Parser._rel_ops)
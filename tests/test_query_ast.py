@@ -2,7 +2,10 @@ import os
 import sys
 import decimal
 import datetime
+import copy
+import pickle
 import operator
+import dataclasses
 import pytest
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", 'simple_query'))
@@ -36,6 +39,7 @@ def test_single_comparison():
     # Make sure case is ignored in field names
     q = QueryAst("COUNT gt 34", CONVERTERS)
     assert(q.ast == Comparison(operator.gt, "count", 34))
+    assert QueryAst("count gt 34", { "Count": int }).ast == q.ast
 
     q = QueryAst("Length lt 12.25", CONVERTERS)
     assert(q.ast == Comparison(operator.lt, "length", 12.25))
@@ -66,6 +70,42 @@ def test_single_comparison():
 
     # Verify that double negation works
     assert QueryAst("count == - -1",    CONVERTERS).ast == Comparison(operator.eq, "count", 1)
+
+    # Converters are still applied to literals of a different type
+    q = QueryAst("count eq 3.75", CONVERTERS)
+    assert q.ast == Comparison(operator.eq, "count", 3) and type(q.ast.value) is int
+    assert type(QueryAst("length gt 3", CONVERTERS).ast.value) is float
+    return
+
+def test_single_comparison_fast_path():
+    'Test that single comparisons parse the same whether or not they take the fast path'
+    for ex in ("count gt 34", "COUNT >= -3", "length\tLe 2.", 'date eq "2019-08-18"', "cost ne '7.5'"):
+        assert QueryAst(ex, CONVERTERS).ast == QueryAst(f"({ex})", CONVERTERS).ast
+
+    # Queries which merely resemble a single comparison must still be rejected
+    verify_bad_syntax_reported("count eq3", "Unknown comparison operator 'eq3'")
+    verify_bad_syntax_reported("count eq 3x", "Unsupported expression")
+    verify_bad_syntax_reported("not eq 3")
+    verify_bad_syntax_reported("\u212aount eq 3", "Unsupported expression")    # Starts with a Kelvin sign, not a K
+    verify_bad_syntax_reported("\u017fize eq 3", "Unsupported expression")     # Starts with a long s
+    verify_bad_syntax_reported("count eq \u0663", "Value is not a number or a string")          # Arabic-Indic digit
+    verify_bad_syntax_reported("count eq \uff13\uff14", "Value is not a number or a string")    # Full-width digits
+    verify_bad_syntax_reported("length gt \u0663.5", "Value is not a number or a string")
+    verify_bad_syntax_reported("count\xa0eq 3", "Unsupported expression")                       # Non-breaking space
+    return
+
+def test_number_literals():
+    'Numbers are plain decimals, unlike Python number literals'
+    # Leading zeros are allowed, e.g. for times of day in hhmmss format
+    assert QueryAst("count eq 092701", CONVERTERS).ast == Comparison(operator.eq, "count", 92701)
+    assert QueryAst("count eq 0", CONVERTERS).ast == Comparison(operator.eq, "count", 0)
+    assert QueryAst("length eq .5", CONVERTERS).ast == Comparison(operator.eq, "length", 0.5)
+    assert QueryAst("length eq 5.", CONVERTERS).ast == Comparison(operator.eq, "length", 5.0)
+
+    # Exponents, hexadecimal numbers and underscores are not supported
+    for ex in ("count eq 1e3", "length eq .5e1", "count eq 0x10", "count eq 1_000"):
+        verify_bad_syntax_reported(ex, "Unsupported expression")
+        verify_bad_syntax_reported(f"({ex})", "invalid syntax")
     return
 
 def test_undefined_field():
@@ -111,6 +151,12 @@ def test_malformed():
     with pytest.raises(NameError, match="No such field 'size'"):
         QueryAst("size gt 3", CONVERTERS)
 
+    # Only ASCII digits and whitespace are allowed
+    verify_bad_syntax_reported("count eq 3 and (count eq \u0663)", "Value is not a number or a string")
+    verify_bad_syntax_reported("count eq 3 and (count eq \uff13\uff14)", "Value is not a number or a string")
+    verify_bad_syntax_reported("count eq 3 and (length gt \u0663.5)", "Value is not a number or a string")
+    verify_bad_syntax_reported("count eq 3 and (count\xa0eq 3)", "Unsupported expression")
+
     # Unbalanced quotes
     verify_bad_syntax_reported("date eq '2019-05-01", "EOL while scanning string literal")
     verify_bad_syntax_reported('date eq "2019-05-01', "EOL while scanning string literal")
@@ -126,6 +172,10 @@ def test_malformed():
     verify_bad_syntax_reported("count eq 3 size eq 4")
     verify_bad_syntax_reported("count eq 3 ; size eq 4")
 
+    # Errors on later lines of multi-line queries
+    verify_bad_syntax_reported("count eq 3 AND\ncount eq 3x\nOR count eq 4", "Unsupported expression")
+    verify_bad_syntax_reported("count eq 3 AND\ncount eq 3 AND\n(count eq 4", "unexpected EOF while parsing")
+
     # Malformed negative
     verify_bad_syntax_reported("cost gt -'1.75'", "Attempt to negate non-number")
     return
@@ -158,3 +208,126 @@ def test_parens():
     # Superflouous closing paren in the middle
     verify_bad_syntax_reported("(date eq '2016-05-01')) AND (cost gt 20)")
     return
+
+def test_compile():
+    predicate = QueryAst("date eq '2019-08-18' AND (count lt 20 OR NOT cost ge 10.5)", CONVERTERS).compile()
+    row = { "date": datetime.date(2019, 8, 18), "count": 25, "cost": decimal.Decimal("9.99") }
+    assert predicate(row)
+    assert not predicate(dict(row, cost=decimal.Decimal(11)))
+    assert predicate(dict(row, count=3, cost=decimal.Decimal(11)))
+    assert not predicate(dict(row, date=datetime.date(2019, 8, 19)))
+
+    predicate = QueryAst("length gt 1.5", CONVERTERS).compile()
+    assert predicate({ "length": 2.0 })
+    assert not predicate({ "length": 1.0 })
+    return
+
+def test_to_numpy_mask():
+    np = pytest.importorskip("numpy")
+    columns = {
+        "date": np.array(["2019-08-18", "2019-08-18", "2019-08-19", "2019-08-18"], dtype="datetime64[D]"),
+        "count": np.array([25, 3, 3, 25]),
+        "length": np.array([9.5, 11.0, 9.5, 11.0]),
+    }
+    q = QueryAst("date eq '2019-08-18' AND (count lt 20 OR NOT length ge 10.5)", CONVERTERS)
+    assert q.to_numpy_mask(columns).tolist() == [True, True, False, False]
+
+    rows = [ { name: column[i] for name, column in columns.items() } for i in range(4) ]
+    assert q.to_numpy_mask(columns).tolist() == list(map(q.compile(), rows))
+
+    assert QueryAst("count gt 10", CONVERTERS).to_numpy_mask(columns).tolist() == [True, False, False, True]
+    return
+
+def test_cached():
+    QueryAst.cache_clear()
+    q1 = QueryAst("count gt 34 and length lt 12.25", CONVERTERS)
+    q2 = QueryAst("count gt 34 and length lt 12.25", dict(CONVERTERS))
+    assert q1.ast is q2.ast
+
+    # Different converters must not share a cached tree
+    q3 = QueryAst("count gt 34 and length lt 12.25", dict(CONVERTERS, count=float))
+    assert q3.ast is not q1.ast
+
+    # Cached trees are shared, so they must not be mutable
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        q1.ast.op = operator.or_
+
+    # Frozen nodes are hashable, so equal trees may be used as keys
+    assert hash(q1.ast) == hash(q3.ast)
+    assert { q1.ast: 1 }[q3.ast] == 1
+
+    QueryAst.cache_clear()
+    assert QueryAst._compile_cached.cache_info().currsize == 0
+    return
+
+def test_interned():
+    q1 = QueryAst("count gt 3 and NOT (length lt 2 or date eq '2019-08-18')", CONVERTERS, intern_nodes=True)
+    q2 = QueryAst("(length lt 2 OR date eq '2019-08-18') and count gt 3", CONVERTERS, intern_nodes=True)
+    assert q1.ast.operands[0] is q2.ast.operands[1]
+    assert q1.ast.operands[1].operands[0] is q2.ast.operands[0]
+
+    # Interning is opt-in
+    q3 = QueryAst("count gt 3 and length lt 2", CONVERTERS)
+    assert q3.ast.operands[0] == q1.ast.operands[0] and q3.ast.operands[0] is not q1.ast.operands[0]
+
+    # Equal values which differ in type or representation must not be merged
+    q4 = QueryAst("count gt 3", dict(CONVERTERS, count=float), intern_nodes=True)
+    assert q4.ast == q1.ast.operands[0]
+    assert type(q4.ast.value) is float
+
+    q5 = QueryAst("cost eq '1.0'", CONVERTERS, intern_nodes=True)
+    q6 = QueryAst("cost eq '1.00'", CONVERTERS, intern_nodes=True)
+    assert str(q5.ast.value) == "1.0" and str(q6.ast.value) == "1.00"
+
+    q7 = QueryAst("length eq 0.0", CONVERTERS, intern_nodes=True)
+    q8 = QueryAst("length eq -0.0", CONVERTERS, intern_nodes=True)
+    assert str(q7.ast.value) == "0.0" and str(q8.ast.value) == "-0.0"
+    return
+
+def test_copy_and_pickle():
+    for ex in ("cost lt '2.5'", "date eq '2019-08-18'", "count gt 3 and cost lt '2.5'",
+               "date eq '2019-08-18' AND (count lt 20 OR NOT length ge 10.5)"):
+        tree = QueryAst(ex, CONVERTERS).ast
+        for copied in (copy.copy(tree), copy.deepcopy(tree), pickle.loads(pickle.dumps(tree))):
+            assert copied == tree and type(copied) is type(tree)
+    return
+
+@dataclasses.dataclass
+class ScaledConverter:
+    factor: int
+
+    def __call__(self, value):
+        return int(value) * self.factor
+
+def test_unhashable_converter():
+    'Converters which cannot be part of the cache key are still applied, without caching'
+    converters = dict(CONVERTERS, count=ScaledConverter(2))
+    assert QueryAst("count gt 3", converters).ast == Comparison(operator.gt, "count", 6)
+    converters["count"].factor = 3
+    assert QueryAst("count gt 3", converters).ast == Comparison(operator.gt, "count", 9)
+    return
+
+def test_warm():
+    QueryAst.cache_clear()
+    QueryAst.warm(["count gt 34", "date eq '2019-08-18' and count lt 20"], CONVERTERS)
+    assert QueryAst._compile_cached.cache_info().currsize == 2
+
+    QueryAst("count gt 34", CONVERTERS)
+    assert QueryAst._compile_cached.cache_info().hits == 1
+
+    with QueryAst.parse_cache_disabled():
+        q = QueryAst("count gt 34", CONVERTERS)
+        QueryAst("length lt 2", CONVERTERS)
+    assert q.ast == Comparison(operator.gt, "count", 34)
+    assert QueryAst._compile_cached.cache_info().hits == 1
+    assert QueryAst._compile_cached.cache_info().currsize == 2
+
+    # Nested use must leave the cache disabled until the outermost context exits
+    with QueryAst.parse_cache_disabled():
+        with QueryAst.parse_cache_disabled():
+            pass
+        QueryAst("count gt 34", CONVERTERS)
+    assert QueryAst._compile_cached.cache_info().hits == 1
+    QueryAst("count gt 34", CONVERTERS)
+    assert QueryAst._compile_cached.cache_info().hits == 2
+    return